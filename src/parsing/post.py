@@ -2,7 +2,7 @@ import json
 import re
 import traceback
 import asyncio.exceptions
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, SoupStrainer
 from bs4.element import NavigableString
 from typing import Optional, Union, List, Iterator
 from emoji import emojize
@@ -482,7 +482,7 @@ class Post:
             if not text:
                 try:
                     page = await web.get(src)
-                    text = BeautifulSoup(page.decode(), 'lxml').title.text
+                    text = BeautifulSoup(page.decode(), 'lxml', parse_only=SoupStrainer('title')).title.text
                 finally:
                     if not text:
                         text = urlparse(src).netloc
@@ -1,9 +1,17 @@
 import asyncio
 import time
+from itertools import cycle
+import orjson
 import aiographfix as aiograph
-from typing import List, Union
-from bs4 import BeautifulSoup
-from aiohttp import ClientTimeout, ClientError
+from functools import lru_cache
+from hashlib import blake2b
+from typing import List, Union, Tuple, Iterator, Optional, Dict, Set
+from html import escape
+from lxml.html import fragment_fromstring, tostring
+from aiographfix.utils.html import html_to_json
+from lxml.html.clean import Cleaner
+from lxml.html.defs import empty_tags
+from aiohttp import ClientTimeout, ClientError, TCPConnector, BaseConnector
 from aiohttp_retry import RetryClient
 from aiohttp_socks import ProxyConnector
 
@@ -12,42 +20,109 @@ from src import env, log
 logger = log.getLogger('RSStT.tgraph')
 
 
+def _json_serialize(obj) -> str:
+    return orjson.dumps(obj).decode()
+
+
 class Telegraph(aiograph.Telegraph):
     def __init__(self, token=None):
         self.last_run = 0
-        self._fc_lock = asyncio.Lock()  # lock: wait if exceed flood control
-        self._request_lock = asyncio.Lock()  # lock: only one request can be sent at the same time
-        super().__init__(token)
+        self._fc_gate = asyncio.Event()  # gate: cleared while exceeding flood control
+        self._fc_gate.set()
+        self._fc_lock = asyncio.Lock()  # lock: guard the check-and-clear of _fc_gate
+        self.resume_at = 0  # when the flood control is expected to be over (monotonic time)
+        self._queue: Optional[asyncio.Queue] = None  # queue: pending create_page requests
+        self._dispatcher: Optional[asyncio.Task] = None
+        self._tasks: Set[asyncio.Task] = set()  # keep references to background tasks until they are done
+        # aiograph serializes the page content itself, the session only posts form data
+        super().__init__(token, json_serialize=_json_serialize, json_deserialize=orjson.loads)
 
-    async def replace_session(self):
+    async def replace_session(self, connector: BaseConnector):
         await self.session.close()
-        proxy_connector = ProxyConnector(**env.TELEGRAPH_PROXY_DICT, loop=self.loop) \
-            if env.TELEGRAPH_PROXY_DICT else None
-        self.session = RetryClient(connector=proxy_connector, timeout=ClientTimeout(total=10),
-                                   loop=self.loop, json_serialize=self._json_serialize)
+        self.session = RetryClient(connector=connector, connector_owner=False, timeout=ClientTimeout(total=10),
+                                   json_serialize=self._json_serialize)
 
     async def create_page(self, *args, **kwargs) -> aiograph.types.Page:
-        async with self._fc_lock:  # if not blocked, continue; otherwise, wait
-            pass
+        if self._dispatcher is None:  # lazily started since a running loop is needed
+            self._queue = asyncio.Queue()
+            self._dispatcher = asyncio.create_task(self._dispatch_loop())
+
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((future, args, kwargs))
+        return await future
+
+    async def _dispatch_loop(self):
+        while True:
+            future, args, kwargs = await self._queue.get()
+            if future.done():  # cancelled by the caller
+                continue
 
-        async with self._request_lock:
-            await asyncio.sleep(max(0.5 - (time.time() - self.last_run), 0))  # avoid exceeding flood control
+            delay = self.last_run + 0.5 - time.monotonic()  # avoid exceeding flood control
+            if delay > 0:
+                await asyncio.sleep(delay)
+            await self._fc_gate.wait()  # if not blocked, continue; otherwise, wait
+            if future.done():  # cancelled while waiting
+                continue
+
+            self.last_run = time.monotonic()
+            # do not wait for the response, the next request only needs to be 0.5s apart
+            self._create_task(self._send_page(future, *args, **kwargs))
+
+    async def _send_page(self, future: asyncio.Future, *args, **kwargs):
+        try:
             page = await super().create_page(*args, **kwargs)
-            self.last_run = time.time()
-            return page
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            if not future.done():
+                future.set_exception(e)
+        else:
+            if not future.done():
+                future.set_result(page)
+
+    @property
+    def available(self) -> bool:
+        return self._fc_gate.is_set()
+
+    def _create_task(self, coro) -> asyncio.Task:
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    def start_flood_wait(self, retry_after: int):
+        task = self._create_task(self.flood_wait(retry_after))
+        task.add_done_callback(self._on_flood_wait_done)
+
+    @staticmethod
+    def _on_flood_wait_done(task: asyncio.Task):
+        if task.cancelled():
+            return
+        e = task.exception()
+        if e:
+            logger.warning('Flood wait failed: ' + str(e), exc_info=e)
 
     async def flood_wait(self, retry_after: int):
-        if not self._fc_lock.locked():  # if not already blocking
-            async with self._fc_lock:  # block any other sending tries
-                logger.info('Blocking any requests for this telegraph account due to flood control...')
-                if retry_after >= 60:
-                    # create a now account if retry_after sucks
-                    await self.create_account(short_name='RSStT', author_name='Generated by RSStT',
-                                              author_url='https://github.com/Rongronggg9/RSS-to-Telegram-Bot')
-                    logger.warning('Wanna let me wait? No way! Created a new Telegraph account.')
-                else:
-                    await asyncio.sleep(retry_after + 1)
-                logger.info('Unblocked.')
+        async with self._fc_lock:
+            if not self._fc_gate.is_set():  # already blocking
+                return
+            self._fc_gate.clear()  # block any other sending tries
+
+        try:
+            logger.info('Blocking any requests for this telegraph account due to flood control...')
+            if retry_after >= 60:
+                self.resume_at = time.monotonic()  # will be available as soon as the new account is created
+                # create a now account if retry_after sucks
+                await self.create_account(short_name='RSStT', author_name='Generated by RSStT',
+                                          author_url='https://github.com/Rongronggg9/RSS-to-Telegram-Bot')
+                logger.warning('Wanna let me wait? No way! Created a new Telegraph account.')
+            else:
+                self.resume_at = time.monotonic() + retry_after + 1
+                await asyncio.sleep(retry_after + 1)
+        finally:
+            self._fc_gate.set()
+            logger.info('Unblocked.')
 
 
 class APIs:
@@ -56,31 +131,52 @@ class APIs:
             tokens = [tokens]
         self.tokens = tokens
         self._accounts: List[Telegraph] = []
-        self._curr_id = 0
-        asyncio.get_event_loop().run_until_complete(self.init())
+        self._cycle: Iterator[Telegraph] = iter(())
+        self._connector: Optional[BaseConnector] = None
+        self.inflight: Dict[bytes, asyncio.Future] = {}  # page hash -> url of the page being created
+
+    @classmethod
+    async def create(cls, tokens: Union[str, List[str]]) -> 'APIs':
+        self = cls(tokens)
+        await self.init()
+        return self
 
     async def init(self):
-        for token in self.tokens:
-            token = token.strip()
-            account = Telegraph(token)
-            await account.replace_session()
+        # all accounts share one connector since they all talk to the same host
+        connector_kwargs = {'limit': 100, 'ttl_dns_cache': 300, 'keepalive_timeout': 75}
+        self._connector = ProxyConnector(**env.TELEGRAPH_PROXY_DICT, **connector_kwargs) \
+            if env.TELEGRAPH_PROXY_DICT else TCPConnector(**connector_kwargs)
+        accounts = await asyncio.gather(*(self._init_one(token.strip()) for token in self.tokens))
+        self._accounts = [account for account in accounts if account]
+        self._cycle = cycle(self._accounts)  # round-robin
+
+    async def _init_one(self, token: str) -> Optional[Telegraph]:
+        account = Telegraph(token)
+        await account.replace_session(self._connector)
+        try:
+            if len(token) != 60:  # must be an invalid token
+                logger.warning('Telegraph API token may be invalid, create one instead.')
+                await account.create_account(short_name='RSStT', author_name='Generated by RSStT',
+                                             author_url='https://github.com/Rongronggg9/RSS-to-Telegram-Bot')
+            await account.get_account_info()
+            return account
+        except aiograph.exceptions.TelegraphError as e:
+            logger.warning('Telegraph API token may be invalid, create one instead: ' + str(e))
             try:
-                if len(token) != 60:  # must be an invalid token
-                    logger.warning('Telegraph API token may be invalid, create one instead.')
-                    await account.create_account(short_name='RSStT', author_name='Generated by RSStT',
-                                                 author_url='https://github.com/Rongronggg9/RSS-to-Telegram-Bot')
-                await account.get_account_info()
-                self._accounts.append(account)
-            except aiograph.exceptions.TelegraphError as e:
-                logger.warning('Telegraph API token may be invalid, create one instead: ' + str(e))
-                try:
-                    await account.create_account(short_name='RSStT', author_name='Generated by RSStT',
-                                                 author_url='https://github.com/Rongronggg9/RSS-to-Telegram-Bot')
-                    self._accounts.append(account)
-                except Exception as e:
-                    logger.warning('Cannot set up one of Telegraph accounts: ' + str(e), exc_info=e)
+                await account.create_account(short_name='RSStT', author_name='Generated by RSStT',
+                                             author_url='https://github.com/Rongronggg9/RSS-to-Telegram-Bot')
+                return account
             except Exception as e:
                 logger.warning('Cannot set up one of Telegraph accounts: ' + str(e), exc_info=e)
+        except Exception as e:
+            logger.warning('Cannot set up one of Telegraph accounts: ' + str(e), exc_info=e)
+        return None
+
+    async def close(self):
+        for account in self._accounts:
+            await account.session.close()
+        if self._connector:
+            await self._connector.close()  # owned by APIs rather than any session
 
     @property
     def valid(self):
@@ -94,25 +190,167 @@ class APIs:
         if not self._accounts:
             raise aiograph.exceptions.TelegraphError('Telegraph token no set!')
 
-        curr_id = self._curr_id if 0 <= self._curr_id < len(self._accounts) else 0
-        self._curr_id = curr_id + 1 if 0 <= curr_id + 1 < len(self._accounts) else 0
-        return self._accounts[curr_id]
+        for _ in range(len(self._accounts)):  # skip accounts being flood-controlled
+            account = next(self._cycle)
+            if account.available:
+                return account
+
+        # all accounts are being flood-controlled, use the one that will be available first
+        return min(self._accounts, key=lambda account: account.resume_at)
+
+
+apis: Optional[APIs] = None  # set up by init() at startup
 
 
-apis = None
-if env.TELEGRAPH_TOKEN:
-    apis = APIs(env.TELEGRAPH_TOKEN.split(','))
-    if not apis.valid:
-        logger.error('Cannot set up Telegraph, fallback to non-Telegraph mode.')
-        apis = None
+async def init():
+    global apis
+    if env.TELEGRAPH_TOKEN:
+        apis = await APIs.create(env.TELEGRAPH_TOKEN.split(','))
+        if not apis.valid:
+            logger.error('Cannot set up Telegraph, fallback to non-Telegraph mode.')
+            apis = None
 
-TELEGRAPH_ALLOWED_TAGS = {
+
+async def close():
+    if apis:
+        await apis.close()
+
+
+TELEGRAPH_ALLOWED_TAGS = frozenset({
     'a', 'aside', 'b', 'blockquote', 'br', 'code', 'em', 'figcaption', 'figure',
     'h3', 'h4', 'hr', 'i', 'iframe', 'img', 'li', 'ol', 'p', 'pre', 's',
     'strong', 'u', 'ul', 'video'
-}
+})
+
+ALLOWED_ATTRS = frozenset({'href', 'src'})
+
+BOILERPLATE = ("<br><br>Generated by "
+               "<a href='https://github.com/Rongronggg9/RSS-to-Telegram-Bot'>RSStT</a>. "
+               "The copyright belongs to the source site.<br>"
+               "If images cannot be loaded properly due to anti-hotlinking, "
+               "please consider install "
+               "<a href='https://greasyfork.org/scripts/432923'>this userscript</a>.")
+
+TRUNCATED_NOTICE = '<br><br>…(truncated)'
+
+# Telegraph rejects pages of more than 64KB with CONTENT_TOO_BIG, leave some margin
+# measured as the serialized nodes aiograph sends, not as the html
+CONTENT_SIZE_LIMIT = 60000
+
+cleaner = Cleaner(allow_tags=TELEGRAPH_ALLOWED_TAGS, remove_unknown_tags=False,
+                  safe_attrs=ALLOWED_ATTRS, safe_attrs_only=True,
+                  embedded=False, frames=False, forms=False, annoying_tags=False)  # keep iframe and video
 
-ALLOWED_ATTRS = {'href', 'src'}
+
+def _text_size(text: str) -> int:
+    return len(orjson.dumps(text)) + 1  # with a comma
+
+
+def _node_size(html: str) -> int:
+    return len(orjson.dumps(html_to_json(html))) - 1  # without the brackets, with a comma
+
+
+def _truncate_text(text: str, max_size: int) -> str:
+    low, high = 0, len(text)  # find the longest prefix that fits
+    while low < high:
+        mid = (low + high + 1) // 2
+        if _text_size(text[:mid]) <= max_size:
+            low = mid
+        else:
+            high = mid - 1
+    return text[:low]
+
+
+def _truncate(parent, max_size: int) -> bool:
+    """
+    Drop the trailing contents of an element that exceed the size, descending into the child crossing the limit.
+
+    :param parent: lxml element
+    :param max_size: max size of the contents, measured as the node payload that aiograph sends (in bytes)
+    :return: is truncated?
+    """
+    size = 0
+    if parent.text:
+        size += _text_size(parent.text)
+        if size > max_size:
+            parent.text = _truncate_text(parent.text, max_size)
+            del parent[:]
+            return True
+
+    for i, child in enumerate(parent):
+        tail, child.tail = child.tail, None
+        child_size = _node_size(tostring(child, encoding='unicode', method='html'))
+        if size + child_size > max_size:
+            shell = child.makeelement(child.tag, child.attrib)
+            shell.text = ''  # or lxml may omit the end tag
+            shell_size = _node_size(tostring(shell, encoding='unicode', method='html')) + len(',"children":[]')
+            if (child.text or len(child)) and size + shell_size < max_size:
+                _truncate(child, max_size - size - shell_size)
+                del parent[i + 1:]
+            else:
+                del parent[i:]
+            return True
+        size += child_size
+
+        if tail:
+            child.tail = tail
+            size += _text_size(tail)
+            if size > max_size:
+                child.tail = _truncate_text(tail, max_size - size + _text_size(tail))
+                del parent[i + 1:]
+                return True
+
+    return False
+
+
+def _keep_end_tags(tree):
+    for element in tree.iter():
+        if not element.text and not len(element) and element.tag not in empty_tags:
+            element.text = ''  # or lxml may omit the end tag (e.g. `<li>`), which aiograph refuses to parse
+
+
+def sanitize_html(xml: str, max_size: Optional[int] = None) -> Tuple[str, bool]:
+    """
+    :param xml: post content (xml or html)
+    :param max_size: if set, truncate the content to this size, measured as the node payload that aiograph sends
+    :return: (sanitized html, is truncated?)
+    """
+    tree = fragment_fromstring(xml or '', create_parent='div')
+    cleaner(tree)  # remove disallowed tags and attrs
+    _keep_end_tags(tree)
+    truncated = _truncate(tree, max_size) if max_size is not None else False
+    if truncated:
+        _keep_end_tags(tree)  # truncating may leave elements empty
+    # serialize only the contents, the container div is not allowed by Telegraph
+    return escape(tree.text or '', quote=False) + ''.join(tostring(child, encoding='unicode', method='html')
+                                                          for child in tree), truncated
+
+
+@lru_cache(maxsize=512)
+def build_page(xml: str = None, title: str = None, link: str = None, feed_title: str = None,
+               author: str = None) -> Tuple[str, str, str, str]:
+    """
+    :return: (title, author, author_url, html_content)
+    """
+    source = f"<br><br><a href='{link}'>Source</a>" if link else ''
+    max_size = CONTENT_SIZE_LIMIT - _node_size(TRUNCATED_NOTICE + BOILERPLATE + source)
+    content, truncated = sanitize_html(xml, max_size)  # truncate locally rather than let Telegraph reject it
+    if truncated and not content:  # nothing fits, let the caller send a pure link instead
+        raise aiograph.exceptions.TelegraphError('CONTENT_TOO_BIG')
+
+    if feed_title:
+        telegraph_author = f"{feed_title}"
+        if author and author not in feed_title:
+            telegraph_author += f' ({author})'
+        telegraph_author_url = link if link else ''
+    else:
+        telegraph_author = 'Generated by RSStT'
+        telegraph_author_url = 'https://github.com/Rongronggg9/RSS-to-Telegram-Bot'
+
+    telegraph_title = title if title else 'Generated by RSStT'
+    telegraph_html_content = ''.join((content, TRUNCATED_NOTICE if truncated else '', BOILERPLATE, source))
+    # clip to the limits of Telegraph
+    return telegraph_title[:256], telegraph_author[:128], telegraph_author_url[:512], telegraph_html_content
 
 
 class TelegraphIfy:
@@ -123,65 +361,71 @@ class TelegraphIfy:
         if not apis:
             raise aiograph.exceptions.TelegraphError('Telegraph token no set!')
 
-        soup = BeautifulSoup(xml, 'lxml')
-
-        for tag in soup.find_all(recursive=True):
-            if tag.name not in TELEGRAPH_ALLOWED_TAGS:
-                tag.replaceWithChildren()  # remove disallowed tags
-                continue
-            for attr in tuple(tag.attrs.keys()):
-                if attr not in ALLOWED_ATTRS:
-                    del tag.attrs[attr]  # remove disallowed attrs
-
-        if feed_title:
-            self.telegraph_author = f"{feed_title}"
-            if author and author not in feed_title:
-                self.telegraph_author += f' ({author})'
-            self.telegraph_author_url = link if link else ''
-        else:
-            self.telegraph_author = 'Generated by RSStT'
-            self.telegraph_author_url = 'https://github.com/Rongronggg9/RSS-to-Telegram-Bot'
-
-        self.telegraph_title = title if title else 'Generated by RSStT'
-        self.telegraph_html_content = (str(soup) +
-                                       "<br><br>Generated by "
-                                       "<a href='https://github.com/Rongronggg9/RSS-to-Telegram-Bot'>RSStT</a>. "
-                                       "The copyright belongs to the source site.<br>"
-                                       "If images cannot be loaded properly due to anti-hotlinking, "
-                                       "please consider install "
-                                       "<a href='https://greasyfork.org/scripts/432923'>this userscript</a>." +
-                                       f"<br><br><a href='{link}'>Source</a>" if link else '')
+        self.telegraph_title, self.telegraph_author, self.telegraph_author_url, self.telegraph_html_content = \
+            build_page(xml, title, link, feed_title, author)
 
     async def telegraph_ify(self):
-        if self.retries >= 3:
-            raise OverflowError
-
-        if self.retries >= 1:
-            logger.info('Retrying using another telegraph account...' if apis.count > 1 else 'Retrying...')
+        # coalesce identical pages being created concurrently (e.g. the same post sent by two monitor runs)
+        page_id = '\0'.join((self.telegraph_title, self.telegraph_author, self.telegraph_author_url,
+                             self.telegraph_html_content))
+        key = blake2b(page_id.encode('utf-8'), digest_size=16).digest()
+        while True:
+            future = asyncio.get_running_loop().create_future()
+            inflight = apis.inflight.setdefault(key, future)
+            if inflight is future:
+                break
+            try:
+                return await asyncio.shield(inflight)  # do not cancel the owner if the waiter is cancelled
+            except asyncio.CancelledError:
+                if not inflight.cancelled():  # the waiter itself is cancelled
+                    raise
+                # the owner is cancelled, try to take it over
 
-        telegraph_account = apis.get_account()
         try:
-            telegraph_page = await telegraph_account.create_page(title=self.telegraph_title[:256],
-                                                                 content=self.telegraph_html_content,
-                                                                 author_name=self.telegraph_author[:128],
-                                                                 author_url=self.telegraph_author_url[:512])
-            return telegraph_page.url
-        except aiograph.exceptions.TelegraphError as e:
-            e_msg = str(e)
-            if e_msg.startswith('FLOOD_WAIT_'):  # exceed flood control
-                retry_after = int(e_msg.split('_')[-1])
-                logger.warning(f'Flood control exceeded. Wait {retry_after}.0 seconds')
-                self.retries += 1
-                rets = await asyncio.gather(self.telegraph_ify(), telegraph_account.flood_wait(retry_after))
+            url = await self._telegraph_ify()
+            future.set_result(url)
+            return url
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            future.exception()  # mark as retrieved, the owner re-raises it anyway
+            raise
+        finally:
+            del apis.inflight[key]
 
-                return rets[0]
-            else:
+    async def _telegraph_ify(self):
+        while self.retries < 3:
+            if self.retries >= 1:
+                logger.info('Retrying using another telegraph account...' if apis.count > 1 else 'Retrying...')
+
+            telegraph_account = apis.get_account()
+            try:
+                telegraph_page = await telegraph_account.create_page(title=self.telegraph_title,
+                                                                     content=self.telegraph_html_content,
+                                                                     author_name=self.telegraph_author,
+                                                                     author_url=self.telegraph_author_url)
+                return telegraph_page.url
+            except aiograph.exceptions.TelegraphError as e:
+                e_msg = str(e)
+                if e_msg.startswith('FLOOD_WAIT_'):  # exceed flood control
+                    retry_after = int(e_msg.split('_')[-1])
+                    logger.warning(f'Flood control exceeded. Wait {retry_after}.0 seconds')
+                    self.retries += 1
+                    # do not wait here, the account blocks itself and the next try may use another account
+                    telegraph_account.start_flood_wait(retry_after)
+                    await asyncio.sleep(0)  # let flood_wait() close the gate before the next try
+                    continue
+                raise e
+            except (TimeoutError, asyncio.exceptions.TimeoutError) as e:
+                raise e  # aiohttp_retry will retry automatically, so it means too many retries if caught
+            except (ClientError, ConnectionError) as e:
+                self.retries += 1
+                if self.retries < 3:
+                    logger.warning(
+                        f'Network error ({e.__class__.__name__}) occurred when creating telegraph page, will retry')
+                    continue
                 raise e
-        except (TimeoutError, asyncio.exceptions.TimeoutError) as e:
-            raise e  # aiohttp_retry will retry automatically, so it means too many retries if caught
-        except (ClientError, ConnectionError) as e:
-            if self.retries < 3:
-                logger.warning(
-                    f'Network error ({e.__class__.__name__}) occurred when creating telegraph page, will retry')
-                return await self.telegraph_ify()
-            raise e
+
+        raise OverflowError
@@ -305,6 +305,8 @@ async def rss_monitor(fetch_all: bool = False):
 
 def main():
     global feeds
+    asyncio.get_event_loop().run_until_complete(tgraph.init())
+
     logger.info(f"RSS-to-Telegram-Bot ({', '.join(env.VERSION.split())}) started!\n"
                 f"CHATID: {env.CHATID}\n"
                 f"MANAGER: {env.MANAGER}\n"
@@ -334,6 +336,7 @@ def main():
     scheduler.start()
 
     bot.run_until_disconnected()
+    asyncio.get_event_loop().run_until_complete(tgraph.close())
 
 
 if __name__ == '__main__':